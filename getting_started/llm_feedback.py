@@ -1,23 +1,87 @@
 from pathlib import Path
 from langchain.schema import AIMessage, HumanMessage
+import hashlib
+import json
+import os
+import re
 import subprocess
+import threading
+from collections import deque
+
+
+# On-disk cache of LLM responses keyed by the full message transcript, so
+# re-running the same task (e.g. restarting the notebook) skips the Ollama
+# round-trip entirely.
+CACHE_PATH = Path(".llm_response_cache.json")
+
+
+def _transcript_key(messages):
+    hasher = hashlib.sha256()
+    for message in messages:
+        hasher.update(message.type.encode("utf-8"))
+        hasher.update(str(message.content).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _load_response_cache():
+    if CACHE_PATH.exists():
+        try:
+            return json.loads(CACHE_PATH.read_text())
+        except json.JSONDecodeError:
+            return {}
+    return {}
+
+
+def cached_invoke(llm, messages, response_model=None):
+    """
+    Call the LLM, reusing a cached response when the exact same message
+    transcript has been sent before.
+
+    Parameters:
+    - llm: The language model instance to call.
+    - messages: A list of messages to send to the LLM.
+    - response_model: The Pydantic model class used to rebuild cached
+      responses. If None, caching is skipped and the LLM is always called.
+
+    Returns:
+    - The LLM response (fresh or rebuilt from the cache).
+    """
+    if response_model is None:
+        return llm.invoke(messages)
+
+    cache = _load_response_cache()
+    key = _transcript_key(messages)
+    if key in cache:
+        print("♻️ Reusing cached LLM response for an identical transcript.")
+        return response_model.model_validate(cache[key])
+
+    response = llm.invoke(messages)
+    cache[key] = response.model_dump()
+    CACHE_PATH.write_text(json.dumps(cache))
+    return response
 
 
 # Define a function to iterate through LLM call and message appends
-def llm_feedback_loop(task, llm, messages, max_iterations=5):
+def llm_feedback_loop(task, llm, messages, max_iterations=5, response_model=None,
+                      history_window=3):
     """
     Iteratively call the LLM with the provided messages and append the response to the messages.
-    
+
     Parameters:
     - llm: The language model instance to call.
     - messages: A list of messages to send to the LLM.
     - max_iterations: Maximum number of iterations to perform.
-    
+    - response_model: Optional Pydantic model class enabling the response cache.
+    - history_window: How many past feedback exchanges to keep in the transcript.
+
     Returns:
     - The final response from the LLM after all iterations.
     """
+    base_len = len(messages)  # the caller's prompt, always kept intact
+    executed = {}  # script hash -> captured output, so identical code is not re-run
+    errors_seen = []  # error signatures from earlier iterations, oldest first
     for i in range(max_iterations):
-        response = llm.invoke(messages)
+        response = cached_invoke(llm, messages, response_model=response_model)
 
         print("✅ Analysis generated!")
         print(f"Completed Status: {response.status_complete}")
@@ -29,40 +93,156 @@ def llm_feedback_loop(task, llm, messages, max_iterations=5):
             print("LLM response: completed successfully.")
             break
 
-        # Run the R script and capture output
-        output = run_r_script(task, response)
+        # Run the R script and capture output; an unchanged script would just
+        # reproduce the previous run, so reuse its output instead
+        script_hash = hashlib.sha256(response.script.encode("utf-8")).hexdigest()
+        if script_hash in executed:
+            print("♻️ Script identical to a previous attempt; reusing its output.")
+            output = executed[script_hash]
+        else:
+            output = run_r_script(task, response)
+            executed[script_hash] = output
         print(output)
 
+        # The history window below drops old exchanges, so carry a compact
+        # memory of past failures forward in the feedback itself: the model
+        # should not re-try an approach that already failed
+        feedback = output
+        signature = error_signature(output)
+        if signature:
+            if signature in errors_seen:
+                feedback += (
+                    "\n\n[NOTE] This exact error already occurred in an earlier "
+                    "attempt. That approach failed; try a different one."
+                )
+            else:
+                errors_seen.append(signature)
+            if len(errors_seen) > 1:
+                memory = "\n".join(f"- {s}" for s in errors_seen)[:ERROR_MEMORY_CHARS]
+                feedback += f"\n\nErrors already seen this session:\n{memory}"
+
         # Append the model output and the script results to the messages
         messages.append(
             AIMessage(content=response.model_dump_json())
         )
         messages.append(
-            HumanMessage(content=output)
+            HumanMessage(content=feedback)
         )
 
+        # Keep the transcript bounded: the original prompt stays intact, but
+        # only the last `history_window` feedback exchanges are retained
+        if len(messages) > base_len + 2 * history_window:
+            del messages[base_len:len(messages) - 2 * history_window]
+
         print(f"Iteration {i + 1}: {response}")
     
     return response
 
+# Local models sometimes wrap the script in markdown code fences even when
+# asked for structured output; precompiled so the strip is a single pass.
+_CODE_FENCE_RE = re.compile(r"^\s*```[\w-]*[ \t]*\n|\n?```\s*$")
+
+
+def strip_code_fences(script):
+    """Remove a leading/trailing markdown code fence from an LLM-generated script."""
+    if "```" not in script:
+        return script
+    return _CODE_FENCE_RE.sub("", script)
+
+
+# Pull a short, stable signature line out of R stderr so repeated failures
+# can be recognised across iterations.
+_ERROR_LINE_RE = re.compile(r"^Error\b.*$", re.MULTILINE)
+
+# Cap the cross-iteration error memory injected into feedback (characters).
+ERROR_MEMORY_CHARS = 2000
+
+
+def error_signature(output):
+    """Return the last R 'Error ...' line from captured output, or None."""
+    matches = _ERROR_LINE_RE.findall(output)
+    return matches[-1][:200] if matches else None
+
+
+# Keep only the tail of captured R output before it enters the transcript:
+# the error (and the model's token budget) lives at the end, not in the
+# pages of package startup messages nlmixr2 prints first.
+OUTPUT_TAIL_CHARS = 4000
+
+
+def tail_output(text, limit=OUTPUT_TAIL_CHARS):
+    """Truncate captured output to its last `limit` characters."""
+    if len(text) <= limit:
+        return text
+    return f"[... {len(text) - limit} characters truncated ...]\n" + text[-limit:]
+
+
+def write_script(script_path, text):
+    """Atomically write a script file: write a sibling temp file, then os.replace.
+
+    Skips the write entirely when the on-disk content already matches, so
+    saving is decoupled from (and free on) unchanged re-runs.
+    """
+    if script_path.exists() and script_path.read_text() == text:
+        return
+    tmp_path = script_path.with_name(script_path.name + ".tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, script_path)
+
+
+# Keep at most this many lines of each stream while the script runs, so a
+# chatty or runaway script cannot grow memory without bound.
+MAX_OUTPUT_LINES = 1024
+
+
+def _drain(stream, buffer):
+    for line in stream:
+        buffer.append(line)
+    stream.close()
+
+
 # Define function to write and run R script
-def run_r_script(task, response):
+def run_r_script(task, response, timeout=180):
+    # An empty script is a deterministic failure; don't pay for a fork to find out
+    script_text = strip_code_fences(response.script)
+    if not script_text.strip():
+        return "STDERR:\n[The generated script was empty. Provide a complete R script.]"
+
     # Write R script to the current directory
     script_path = Path(task.task_name.replace(" ", "_") + "_analysis.R")
-    script_path.write_text(response.script)
-    
-    # Execute R script in the current directory
-    result = subprocess.run(
-        ["Rscript", str(script_path)],
+    write_script(script_path, script_text)
+
+    # Execute R script in the current directory, streaming output into
+    # bounded tails instead of buffering everything in memory
+    process = subprocess.Popen(
+        ["Rscript", "--vanilla", str(script_path)],
         cwd=".",
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
         text=True,
-        timeout=180
+        bufsize=1
     )
+    stdout_tail = deque(maxlen=MAX_OUTPUT_LINES)
+    stderr_tail = deque(maxlen=MAX_OUTPUT_LINES)
+    readers = [
+        threading.Thread(target=_drain, args=(process.stdout, stdout_tail), daemon=True),
+        threading.Thread(target=_drain, args=(process.stderr, stderr_tail), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        stderr_tail.append(f"\n[Rscript timed out after {timeout}s and was killed]")
+    for reader in readers:
+        reader.join()
+
     # Check if the script ran successfully
-    if result.returncode == 0:
-       output = f"STDOUT:\n{result.stdout}"
+    if process.returncode == 0:
+       output = f"STDOUT:\n{tail_output(''.join(stdout_tail))}"
     else:
-        output = f"STDERR:\n{result.stderr}"
-   
+        output = f"STDERR:\n{tail_output(''.join(stderr_tail))}"
+
     return output
\ No newline at end of file